@@ -1,6 +1,123 @@
 import starsim as ss
 import sciris as sc
 import numpy as np
+import numba as nb
+from collections import namedtuple
+
+_NEVER = np.iinfo(np.int32).max # Time index used in place of NaN for int32 timers
+
+# The raw, UID-indexed arrays of the states of one zombie disease. Starsim stores
+# each state in its own contiguous array (structure of arrays), and this groups
+# the ones that are read together so that they can be passed to the Numba
+# kernels as a single argument; see Zombie.raw.
+ZombieState = namedtuple('ZombieState', ['infected', 'fast', 'symptomatic', 'ti_slow', 'ti_dead'])
+
+
+@nb.njit(cache=True)
+def _zombie_uids(alive, infected, symptomatic, out):
+    """
+    Write the UIDs of alive, symptomatic zombies to out in a single pass, and
+    return how many were found. The infected and symptomatic arguments are
+    tuples of raw arrays, with one entry per zombie disease. Since the length of
+    a tuple is part of its Numba type, a separate version of the kernel, with
+    the loop over diseases fixed at compile time, is compiled for each number
+    of zombie diseases.
+
+    Like the other kernels below, this sweeps the raw arrays contiguously rather
+    than going through the active UIDs (between timesteps, the active agents are
+    exactly the alive ones), and combines the Boolean states with bitwise & and |
+    instead of branching, so that LLVM can vectorize the loop. The kernels are
+    single-threaded, since sims are parallelized across processes instead (e.g.
+    with sc.parallelize(), which forks and is not safe with Numba's threading layers).
+    """
+    k = 0
+    for i in range(len(alive)):
+        zombie = False
+        for d in range(len(infected)):
+            zombie |= infected[d][i] & symptomatic[d][i]
+        out[k] = i # Always write the UID, but only keep it if eligible
+        k += alive[i] & zombie
+    return k
+
+
+@nb.njit(cache=True)
+def _human_uids(alive, infected, out):
+    """ As above, but write the UIDs of alive agents who are not infected with any zombie disease """
+    k = 0
+    for i in range(len(alive)):
+        zombie = False
+        for d in range(len(infected)):
+            zombie |= infected[d][i]
+        out[k] = i
+        k += alive[i] & (not zombie)
+    return k
+
+
+@nb.njit(cache=True)
+def _update_pre(alive, z, ti):
+    """
+    Make fast zombies slow, in place, once their time to slow down has been
+    reached, and count the alive agents who die of being a zombie on this
+    timestep; fused so that each agent is visited once
+    """
+    infected, fast, ti_slow, ti_dead = z.infected, z.fast, z.ti_slow, z.ti_dead
+    n_dead = 0
+    for i in range(len(fast)):
+        fast[i] &= (ti_slow[i] > ti) | (not infected[i]) # Dead agents are never infected, so are unaffected
+        n_dead += alive[i] & (ti_dead[i] <= ti)
+    return n_dead
+
+
+@nb.njit(cache=True)
+def _set_prognoses(uids, z, symp, dur_fast, will_die, ti, inv_dt, dead):
+    """
+    Set the symptoms and fast-to-slow timers of new zombies in a single pass,
+    writing the UIDs of those who die on infection to dead; return how many die
+    """
+    n = 0
+    k = 0 # Index into dur_fast, which only has entries for fast zombies
+    for j in range(len(uids)):
+        i = uids[j]
+        z.symptomatic[i] = symp[j]
+        if z.fast[i]:
+            z.ti_slow[i] = min(np.round(ti + dur_fast[k] * inv_dt), _NEVER)
+            k += 1
+        if will_die[j]:
+            dead[n] = i
+            n += 1
+    return n
+
+
+@nb.njit(cache=True)
+def _cross_protect(alive, fast_infected, slow_infected, fast_rel_sus, slow_rel_sus, rel_sus):
+    """ Reset rel_sus of alive agents to 1, except where they are infected with the other zombie type; fused for both types """
+    for i in range(len(alive)):
+        if slow_infected[i]:
+            fast_rel_sus[i] = rel_sus
+        elif alive[i]:
+            fast_rel_sus[i] = 1
+        if fast_infected[i]:
+            slow_rel_sus[i] = rel_sus
+        elif alive[i]:
+            slow_rel_sus[i] = 1
+    return
+
+
+def _scratch(buf, n):
+    """ Reuse a UID scratch buffer between timesteps, only reallocating it when the population arrays have grown """
+    if len(buf) != n:
+        buf = np.empty(n, dtype=ss.dtypes.int)
+    return buf
+
+
+def _constant_bernoulli(dist):
+    """ If a distribution is a Bernoulli with p=0 or p=1, return the value it always gives; otherwise, return None """
+    if isinstance(dist, ss.bernoulli):
+        p = dist.pars.p
+        if np.isscalar(p) and p in [0, 1]:
+            return bool(p)
+    return None
+
 
 class Zombie(ss.SIR):
     """ Extent the base SIR class to represent Zombies! """
@@ -23,7 +140,7 @@ class Zombie(ss.SIR):
         self.add_states(
             ss.BoolArr('fast', default=self.pars.p_fast), # True if fast
             ss.BoolArr('symptomatic', default=False), # True if symptomatic
-            ss.FloatArr('ti_slow'), # Time index of changing from fast to slow
+            ss.Arr('ti_slow', dtype=np.int32, nan=_NEVER, coerce=False), # Time index of changing from fast to slow; int32 rather than float to halve memory traffic
         )
 
         # Counters for reporting
@@ -32,38 +149,61 @@ class Zombie(ss.SIR):
 
         return
 
+    def init_pre(self, sim):
+        """ Find the Bernoulli parameters whose outcome is certain, so they don't need random numbers, and precompute 1/dt """
+        super().init_pre(sim)
+        self.constant_pars = {key: _constant_bernoulli(self.pars[key]) for key in ['p_symptomatic', 'p_death_on_zombie_infection']}
+        self.inv_dt = 1/sim.dt # Multiply rather than divide when converting durations to time indices
+        return
+
+    def draw_bernoulli(self, key, uids):
+        """ Draw from the Bernoulli parameter key, or skip the random numbers if the outcome is certain (e.g. the default p_symptomatic=1) """
+        value = self.constant_pars[key]
+        if value is None:
+            return self.pars[key].rvs(uids)
+        return np.broadcast_to(value, len(uids)) # No random numbers, and no copy per agent
+
+    @property
+    def raw(self):
+        """ The raw arrays of the zombie states, like Arr.raw; get these fresh, since they are reallocated as the population grows """
+        return ZombieState(self.infected.raw, self.fast.raw, self.symptomatic.raw, self.ti_slow.raw, self.ti_dead.raw)
+
     def update_pre(self):
         """ Updates states before transmission on this timestep """
-        self.cum_deaths += np.count_nonzero(self.ti_dead <= self.sim.ti)
-
         super().update_pre()
 
-        # Transition from fast to slow
-        fast_to_slow_uids = (self.infected & self.fast & (self.ti_slow <= self.sim.ti)).uids
-        self.fast[fast_to_slow_uids] = False
+        # Transition from fast to slow, and count zombie deaths. This comes after
+        # SIR.update_pre() since that can change infected, but it doesn't change
+        # ti_dead (deaths are requested from People), so the count is the same.
+        self.cum_deaths += _update_pre(self.sim.people.alive.raw, self.raw, self.sim.ti)
 
         return
 
     def set_prognoses(self, uids, source_uids=None):
         """ Set prognoses of new zombies """
+        if not len(uids): # Common on quiet timesteps, e.g. when all new cases are congenital
+            return
         super().set_prognoses(uids, source_uids)
-
-        # Choose which new zombies will be symptomatic
-        self.symptomatic[uids] = self.pars.p_symptomatic.rvs(uids)
-
-        # Set timer for fast to slow transition
-        fast_uids = uids[self.fast[uids]]
-        dur_fast = self.pars.dur_fast.rvs(fast_uids)
-        self.ti_slow[fast_uids] = np.round(self.sim.ti + dur_fast / self.sim.dt)
-
-        # Handle possible immediate death on zombie infection
-        dead_uids = self.pars.p_death_on_zombie_infection.filter(uids)
-        self.cum_deaths += len(dead_uids)
+        p = self.pars
+
+        # Choose which new zombies will be symptomatic, how long fast zombies
+        # stay fast, and who dies immediately on zombie infection
+        symptomatic = self.draw_bernoulli('p_symptomatic', uids)
+        dur_fast = p.dur_fast.rvs(uids[self.fast[uids]])
+        will_die = self.draw_bernoulli('p_death_on_zombie_infection', uids)
+
+        # Apply them, and set the timer for the fast to slow transition
+        dead_uids = np.empty(len(uids), dtype=ss.dtypes.int)
+        n = _set_prognoses(uids, self.raw, symptomatic, dur_fast, will_die, self.sim.ti, self.inv_dt, dead_uids)
+        dead_uids = dead_uids[:n].view(ss.uids)
+        self.cum_deaths += n
         self.sim.people.request_death(dead_uids)
         return
 
     def set_congenital(self, target_uids, source_uids=None):
         """ Congenital zombies """
+        if not len(target_uids):
+            return
         self.cum_congenital += len(target_uids)
         self.set_prognoses(target_uids, source_uids)
         return
@@ -100,16 +240,32 @@ class DeathZombies(ss.Deaths):
 
         return
 
+    def init_pre(self, sim):
+        """ Find the zombie diseases once, rather than on every timestep """
+        super().init_pre(sim)
+        self.zombies = tuple(disease for name, disease in sim.diseases.items() if 'zombie' in name)
+        self.not_zombie = np.empty(0, dtype=ss.dtypes.int)
+
+        # If we have fast_zombie and slow_zombie types, choose slow_zombie; None if
+        # there is neither, which is only an error if someone becomes a zombie
+        key = 'zombie' if 'zombie' in sim.diseases else 'slow_zombie'
+        self.new_zombie = sim.diseases[key] if key in sim.diseases else None
+        return
+
     def apply_deaths(self):
         """ Select people to die """
 
         # Ensure that zombies do not die of natural causes
-        not_zombie = self.sim.people.alive.asnew() # Zombies do not die of natural (demographic) causes
-        for name, disease in self.sim.diseases.items():
-            if 'zombie' in name:
-                not_zombie = not_zombie & (~disease.infected)
-
-        death_uids = self.pars.death_rate.filter(not_zombie.uids)
+        ppl = self.sim.people
+        if self.zombies:
+            infected = tuple(disease.infected.raw for disease in self.zombies)
+            self.not_zombie = not_zombie = _scratch(self.not_zombie, len(ppl.alive.raw))
+            n = _human_uids(ppl.alive.raw, infected, not_zombie) # Zombies do not die of natural (demographic) causes
+            not_zombie = not_zombie[:n].view(ss.uids)
+        else: # Numba can't type an empty tuple of arrays, and everyone is human anyway
+            not_zombie = ppl.alive.uids
+
+        death_uids = self.pars.death_rate.filter(not_zombie)
         zombie_uids, death_uids = self.pars.p_zombie_on_natural_death.filter(death_uids, both=True)
 
         # These uids will die
@@ -118,9 +274,8 @@ class DeathZombies(ss.Deaths):
 
         # And these uids will become zombies
         if len(zombie_uids):
-            # If we have fast_zombie and slow_zombie types, choose slow_zombie
-            zombie = 'zombie' if 'zombie' in self.sim.diseases else 'slow_zombie'
-            self.sim.diseases[zombie].set_prognoses(zombie_uids)
+            zombie = self.new_zombie if self.new_zombie is not None else self.sim.diseases['slow_zombie'] # Raises the usual KeyError
+            zombie.set_prognoses(zombie_uids)
 
         return len(death_uids)
 
@@ -133,21 +288,33 @@ class KillZombies(ss.Intervention):
         self.rate = sc.promotetoarray(rate)
         super().__init__(**kwargs)
 
-        # The killing rate is an interpolation of year-rate values
-        self.p = ss.bernoulli(p= lambda self, sim, uids: np.interp(sim.year, self.year, self.rate*sim.dt))
+        # The killing rate is an interpolation of year-rate values, looked up by time index
+        self.p = ss.bernoulli(p= lambda self, sim, uids: self.p_by_ti[sim.ti])
+        return
+
+    def init_pre(self, sim):
+        """ Find the zombie diseases and the per-timestep probabilities once, rather than on every timestep """
+        super().init_pre(sim)
+        self.zombies = tuple(disease for name, disease in sim.diseases.items() if 'zombie' in name)
+        self.eligible = np.empty(0, dtype=ss.dtypes.int)
+        self.p_by_ti = np.interp(sim.yearvec, self.year, self.rate*sim.dt) # Probability of killing a zombie on each timestep
         return
 
     def apply(self, sim):
-        if sim.year < self.year[0]:
+        if sim.year < self.year[0] or not self.zombies:
             return
 
-        eligible = ~sim.people.alive.asnew()
-        for name, disease in sim.diseases.items():
-            if 'zombie' in name:
-                eligible = eligible | (disease.infected & disease.symptomatic)
-        death_uids = self.p.filter(eligible.uids)
+        ppl = sim.people
+        infected = tuple(disease.infected.raw for disease in self.zombies)
+        symptomatic = tuple(disease.symptomatic.raw for disease in self.zombies)
+        self.eligible = eligible = _scratch(self.eligible, len(ppl.alive.raw))
+        n = _zombie_uids(ppl.alive.raw, infected, symptomatic, eligible)
+        if not n: # No symptomatic zombies, so nothing to draw
+            return 0
+        death_uids = self.p.filter(eligible[:n].view(ss.uids))
 
-        sim.people.request_death(death_uids)
+        if len(death_uids):
+            sim.people.request_death(death_uids)
 
         return len(death_uids)
 
@@ -165,11 +332,26 @@ class zombie_vaccine(ss.sir_vaccine):
         efficacy (float): efficacy of the vaccine (0<=efficacy<=1)
         leaky (bool): see above
     """
+    def init_pre(self, sim):
+        """
+        Create the random number generator used to decide whether the vaccine takes.
+        This belongs to the product rather than being shared at module level, and
+        is reseeded from the sim's rand_seed on every initialization, so each
+        replicate gets its own reproducible stream. The product name is mixed into
+        the seed so that this stream doesn't coincide with other generators seeded
+        from rand_seed alone.
+        """
+        super().init_pre(sim)
+        name_key = int.from_bytes(self.name.encode(), byteorder='big')
+        self.rng = np.random.default_rng([sim.pars.rand_seed or 0, name_key])
+        return
+
     def administer(self, people, uids):        
         if self.pars.leaky:
             people.zombie.rel_sus[uids] *= 1-self.pars.efficacy
         else:
-            people.zombie.rel_sus[uids] *= np.random.binomial(1, 1-self.pars.efficacy, len(uids))
+            take = self.rng.random(len(uids)) < self.pars.efficacy
+            people.zombie.rel_sus[uids[take]] = 0 # Fully protected if the vaccine takes, otherwise unchanged
         return
 
     
@@ -185,17 +367,18 @@ class ZombieConnector(ss.Connector):
         self.update_pars(pars, **kwargs)
         return
 
+    def init_pre(self, sim):
+        """ Look up the fast and slow zombie diseases once, rather than on every timestep """
+        super().init_pre(sim)
+        self.fast = sim.diseases['fast_zombie']
+        self.slow = sim.diseases['slow_zombie']
+        return
+
     def update(self):
         """ Specify cross protection between fast and slow zombies """
 
         ppl = self.sim.people
-        fast = self.sim.diseases['fast_zombie']
-        slow = self.sim.diseases['slow_zombie']
-
-        fast.rel_sus[ppl.alive] = 1
-        fast.rel_sus[slow.infected] = self.pars.rel_sus
-
-        slow.rel_sus[ppl.alive] = 1
-        slow.rel_sus[fast.infected] = self.pars.rel_sus
-
+        fast = self.fast
+        slow = self.slow
+        _cross_protect(ppl.alive.raw, fast.infected.raw, slow.infected.raw, fast.rel_sus.raw, slow.rel_sus.raw, self.pars.rel_sus)
         return